@@ -1,19 +1,21 @@
 import os
+import math
 import fire
 import datetime
-from collections import deque, namedtuple
+from functools import partial
+from contextlib import nullcontext
 
 from tqdm import tqdm
 import numpy as np
 import torch
 from torch import nn
-from torch.utils.data import Dataset, DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from torch.optim import Adam
-from torch.distributions import Categorical
+from torch.nn.parallel import DistributedDataParallel as DDP
 import torch.nn.functional as F
 
 import gym
+from stable_baselines3.common.vec_env import DummyVecEnv, SubprocVecEnv
 import wandb
 import logging
 from typing import Tuple
@@ -26,27 +28,16 @@ device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 # data
 
-Memory = namedtuple(
-    "Memory", ["state", "action", "action_log_prob", "reward", "done", "value"]
-)
-AuxMemory = namedtuple("Memory", ["state", "target_value", "old_values"])
 
-
-class ExperienceDataset(Dataset):
-    def __init__(self, data):
-        super().__init__()
-        self.data = data
-
-    def __len__(self):
-        return len(self.data[0])
-
-    def __getitem__(self, ind):
-        return tuple(map(lambda t: t[ind], self.data))
-
-
-def create_shuffled_dataloader(data, batch_size):
-    ds = ExperienceDataset(data)
-    return DataLoader(ds, batch_size=batch_size, shuffle=True)
+def memmap_(path, *shape):
+    # float32 tensor backed by a file, so the os pages it in and out instead of holding it in memory
+    # the file is created exclusively, an existing file is never overwritten
+    size = int(np.prod(shape))
+    with open(path, "xb") as f:
+        f.truncate(size * 4)
+    return torch.from_file(
+        path, shared=True, size=size, dtype=torch.float32
+    ).view(*shape)
 
 
 # helpers
@@ -60,10 +51,84 @@ def normalize(t, eps=1e-5):
     return (t - t.mean()) / (t.std() + eps)
 
 
-def update_network_(loss, optimizer):
-    optimizer.zero_grad()
-    loss.mean().backward()
-    optimizer.step()
+def update_networks_(loss, optimizers, scaler):
+    # the networks share no parameters, so one backward through the summed losses
+    # gives each network the same gradients as separate backward passes would
+    for optimizer in optimizers:
+        optimizer.zero_grad(set_to_none=True)
+
+    scaler.scale(loss).backward()
+
+    for optimizer in optimizers:
+        scaler.step(optimizer)
+    scaler.update()
+
+
+def compile_(module):
+    # torch.compile captures the forward into cuda graphs, torchscript is the cpu fallback
+    if device.type == "cuda" and hasattr(torch, "compile"):
+        return torch.compile(module, mode="reduce-overhead")
+    return torch.jit.script(module)
+
+
+def unwrap(module):
+    module = getattr(module, "_orig_mod", module)
+    return module.module if isinstance(module, DDP) else module
+
+
+def setup_distributed():
+    # launched with torchrun --nproc_per_node=N ppg.py --distributed
+    global device
+    torch.distributed.init_process_group(backend="nccl")
+    local_rank = int(os.environ["LOCAL_RANK"])
+    device = torch.device(f"cuda:{local_rank}")
+    torch.cuda.set_device(device)
+    return torch.distributed.get_rank()
+
+
+@torch.jit.script
+def compute_gae(
+    rewards: torch.Tensor,
+    values: torch.Tensor,
+    masks: torch.Tensor,
+    gamma: float,
+    lam: float,
+    advantages: torch.Tensor,
+) -> torch.Tensor:
+    # scripted so the reverse recurrence runs in the torchscript interpreter rather than python
+    # values carries the bootstrap value as its last entry, so it is one longer than rewards
+    # advantages are written into the given preallocated tensor
+    deltas = rewards + gamma * values[1:] * masks - values[:-1]
+    gae = torch.zeros_like(deltas[0])
+    for i in range(deltas.shape[0] - 1, -1, -1):
+        gae = deltas[i] + gamma * lam * masks[i] * gae
+        advantages[i] = gae
+    return advantages
+
+
+def compute_gae_without_resets(rewards, values, gamma, lam, advantages):
+    # with no episode ends in the rollout, the advantages are suffix sums of the discounted deltas
+    # which a reversed cumsum computes in parallel, in float64 as the discounts span many magnitudes
+    deltas = rewards + gamma * values[1:] - values[:-1]
+    discount = (gamma * lam) ** torch.arange(
+        len(deltas), dtype=torch.float64, device=deltas.device
+    )
+    discount = discount.view(-1, *((1,) * (deltas.ndim - 1)))
+    discounted = (deltas.double() * discount).flip(0).cumsum(0).flip(0)
+    return advantages.copy_(discounted / discount)
+
+
+def gather_actions(log_probs, actions):
+    return log_probs.gather(-1, actions.unsqueeze(-1)).squeeze(-1)
+
+
+def sample_actions(logits):
+    # gumbel-max trick, the argmax of the logits perturbed by gumbel noise is a sample of their softmax
+    log_probs = F.log_softmax(logits, dim=-1)
+    uniform = torch.empty_like(logits).uniform_(1e-9, 1.0)
+    gumbel = -torch.log(-torch.log(uniform))
+    actions = (logits + gumbel).argmax(dim=-1)
+    return actions, gather_actions(log_probs, actions)
 
 
 def init_(m):
@@ -74,6 +139,31 @@ def init_(m):
             torch.nn.init.zeros_(m.bias)
 
 
+class GraphedForward:
+    # captures a forward pass for a fixed input shape into a cuda graph and replays it
+    # outputs live in static memory and are overwritten by the next call
+
+    def __init__(self, net, example_input, warmup_steps=3):
+        self.static_input = example_input.clone()
+
+        # warm up on a side stream before capture, as required by cuda graphs
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream), torch.no_grad():
+            for _ in range(warmup_steps):
+                net(self.static_input)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph), torch.no_grad():
+            self.static_output = net(self.static_input)
+
+    def __call__(self, x):
+        self.static_input.copy_(x)
+        self.graph.replay()
+        return self.static_output
+
+
 # networks
 
 
@@ -89,9 +179,8 @@ class Actor(nn.Module):
             nn.Tanh(),
         )
 
-        self.action_head = nn.Sequential(
-            nn.Linear(hidden_dim, num_actions), nn.Softmax(dim=-1)
-        )
+        # the action head outputs logits, normalized with log_softmax by the caller
+        self.action_head = nn.Sequential(nn.Linear(hidden_dim, num_actions))
 
         self.value_head = nn.Linear(hidden_dim, 1)
         self.apply(init_)
@@ -121,17 +210,30 @@ class Critic(nn.Module):
 
 
 def clipped_value_loss(values, rewards, old_values, clip):
+    values = values.flatten()
     value_clipped = old_values + (values - old_values).clamp(-clip, clip)
-    value_loss_1 = (value_clipped.flatten() - rewards) ** 2
-    value_loss_2 = (values.flatten() - rewards) ** 2
+    value_loss_1 = (value_clipped - rewards) ** 2
+    value_loss_2 = (values - rewards) ** 2
     return torch.mean(torch.max(value_loss_1, value_loss_2))
 
 
+def policy_and_value(actor, critic, states):
+    # the value baseline comes from the critic, PPG keeps the value function out of the policy network
+    # the actor value head is only trained as an auxiliary target during the auxiliary phase
+    # compiled networks reuse their cuda graph output memory on the next call, so the logits are
+    # cloned before the critic runs
+    action_logits = actor(states)[0].clone()
+    return action_logits, critic(states).flatten()
+
+
 class PPG:
     def __init__(
         self,
         state_dim,
         num_actions,
+        num_steps,
+        num_envs,
+        num_aux_rollouts,
         actor_hidden_dim,
         critic_hidden_dim,
         epochs,
@@ -145,11 +247,53 @@ class PPG:
         eps_clip,
         value_clip,
         writer,
+        rollout_file=None,
+        compile_model=False,
+        distributed=False,
+        precision="fp32",
+        cuda_graph=False,
+        num_env_groups=1,
     ):
         self.actor = Actor(state_dim, actor_hidden_dim, num_actions).to(device)
         self.critic = Critic(state_dim, critic_hidden_dim).to(device)
-        self.opt_actor = Adam(self.actor.parameters(), lr=lr, betas=betas)
-        self.opt_critic = Adam(self.critic.parameters(), lr=lr, betas=betas)
+
+        # gradients are all-reduced across ranks during backward
+        # the actor value head is unused in the policy phase, hence find_unused_parameters
+        if distributed:
+            self.actor = DDP(
+                self.actor, device_ids=[device.index], find_unused_parameters=True
+            )
+            self.critic = DDP(self.critic, device_ids=[device.index])
+
+        if compile_model:
+            # the torchscript fallback cannot script the DDP wrapper
+            assert not distributed or hasattr(
+                torch, "compile"
+            ), "compiling distributed networks needs torch.compile"
+            self.actor = compile_(self.actor)
+            self.critic = compile_(self.critic)
+
+        # rollout batches are always one group of environments, so policy and value can be replayed from one cuda graph
+        # optimizer steps update the parameters in place, which the captured graph reads on every replay
+        self.rollout_act = partial(policy_and_value, self.actor, self.critic)
+
+        if cuda_graph and device.type == "cuda":
+            example_state = torch.zeros(
+                num_envs // num_env_groups, state_dim, device=device
+            )
+            self.rollout_act = GraphedForward(
+                partial(policy_and_value, unwrap(self.actor), unwrap(self.critic)),
+                example_state,
+            )
+
+        # the fused cuda kernel updates every parameter of a network in a single launch
+        adam_kwargs = dict(fused=True) if device.type == "cuda" else dict()
+        self.opt_actor = Adam(
+            self.actor.parameters(), lr=lr, betas=betas, **adam_kwargs
+        )
+        self.opt_critic = Adam(
+            self.critic.parameters(), lr=lr, betas=betas, **adam_kwargs
+        )
 
         self.minibatch_size = minibatch_size
 
@@ -160,14 +304,143 @@ class PPG:
         self.gamma = gamma
         self.beta_s = beta_s
 
+        # the parallel gae needs (gamma * lam) ** num_steps to stay representable in float64
+        discount = gamma * lam
+        min_log_discount = math.log(torch.finfo(torch.float64).tiny)
+        self.parallel_gae = 0 < discount <= 1 and (
+            (num_steps - 1) * math.log(discount) > min_log_discount
+        )
+
         self.eps_clip = eps_clip
         self.value_clip = value_clip
 
         self.writer = writer
 
+        # losses stay on device during an epoch and are written out once at its end
+        self._loss_log = {
+            "policy_loss": [],
+            "value_loss": [],
+            "aux_loss": [],
+            "kl_loss": [],
+        }
+        self._loss_steps = dict.fromkeys(self._loss_log, 0)
+
+        # mixed precision, bf16 needs no loss scaling while fp16 does
+        assert precision in ("fp32", "bf16", "fp16"), f"unknown precision {precision}"
+        assert (
+            precision != "fp16" or device.type == "cuda"
+        ), "fp16 needs loss scaling, which is only available on cuda"
+        self.amp_dtype = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(precision)
+        self.scaler = torch.amp.GradScaler("cuda", enabled=precision == "fp16")
+
+        # rollout storage, written in place at every step of the rollout
+        # for large rollouts the states can live in a memory mapped file and are paged in per minibatch
+        self.memmap_files = []
+        if exists(rollout_file):
+            self.states_buf = memmap_(rollout_file, num_steps, num_envs, state_dim)
+            self.memmap_files.append(rollout_file)
+        else:
+            self.states_buf = torch.empty(num_steps, num_envs, state_dim, device=device)
+        self.actions_buf = torch.empty(
+            num_steps, num_envs, dtype=torch.long, device=device
+        )
+        self.log_probs_buf = torch.empty(num_steps, num_envs, device=device)
+        self.returns_buf = torch.empty(num_steps, num_envs, device=device)
+
+        # the extra row of the values holds the bootstrap value of the state after the rollout
+        self.values_buf = torch.empty(num_steps + 1, num_envs, device=device)
+
+        # rewards and dones come from numpy, stage them in pinned memory and copy once per update
+        pin_memory = device.type == "cuda"
+        self.rewards_buf = torch.empty(num_steps, num_envs, pin_memory=pin_memory)
+        self.dones_buf = torch.empty(num_steps, num_envs, pin_memory=pin_memory)
+
+        # auxiliary storage, one slot per rollout between auxiliary phases, filled up to a write pointer
+        batch_size = num_steps * num_envs
+        if exists(rollout_file):
+            self.aux_states = memmap_(
+                f"{rollout_file}.aux", num_aux_rollouts, batch_size, state_dim
+            )
+            self.memmap_files.append(f"{rollout_file}.aux")
+        else:
+            self.aux_states = torch.empty(
+                num_aux_rollouts, batch_size, state_dim, device=device
+            )
+        self.aux_rewards = torch.empty(num_aux_rollouts, batch_size, device=device)
+        self.aux_old_values = torch.empty(num_aux_rollouts, batch_size, device=device)
+        self.aux_t = 0
+
+        # pinned staging for states paged in from the host, reused once its last copy has completed
+        self._states_staging = torch.empty(
+            minibatch_size, state_dim, pin_memory=pin_memory
+        )
+        self._staging_copied = torch.cuda.Event() if pin_memory else None
+
+        # observations arrive as numpy every rollout step and go through one reusable pinned buffer
+        self._obs_cpu = torch.empty(num_envs, state_dim, pin_memory=pin_memory)
+        self._obs_gpu = torch.empty(num_envs, state_dim, device=device)
+
+    def autocast(self):
+        if not exists(self.amp_dtype):
+            return nullcontext()
+
+        return torch.autocast(device_type=device.type, dtype=self.amp_dtype)
+
+    def flush_losses(self):
+        # one device to host copy per loss instead of a sync per minibatch
+        for name, losses in self._loss_log.items():
+            if len(losses) == 0:
+                continue
+
+            for loss in torch.stack(losses).cpu().tolist():
+                self.writer.add_scalar(f"losses/{name}", loss, self._loss_steps[name])
+                self._loss_steps[name] += 1
+
+            losses.clear()
+
+    def load_obs(self, obs, envs=slice(None)):
+        # sampling an action syncs with the host, so the previous copy out of the pinned buffer is done
+        np.copyto(self._obs_cpu[envs].numpy(), obs)
+        return self._obs_gpu[envs].copy_(self._obs_cpu[envs], non_blocking=True)
+
+    def page_in(self, states, ind):
+        staging = self._states_staging[: len(ind)]
+        self._staging_copied.synchronize()
+        torch.index_select(states, 0, ind, out=staging)
+        states = staging.to(device, non_blocking=True)
+        self._staging_copied.record()
+        return states
+
+    def minibatches(self, data, shuffle=True):
+        # data already on device is sliced directly, states left on the host go through pinned staging
+        on_device = [t.device == device for t in data]
+        perm_device = device if all(on_device) else torch.device("cpu")
+
+        num = len(data[0])
+        if shuffle:
+            perm = torch.randperm(num, device=perm_device)
+        else:
+            perm = torch.arange(num, device=perm_device)
+
+        for ind in perm.split(self.minibatch_size):
+            device_ind = ind.to(device, non_blocking=True)
+            yield tuple(
+                t[device_ind] if d else self.page_in(t, ind)
+                for t, d in zip(data, on_device)
+            )
+
+    def close(self):
+        # the memory mapped files are scratch space created by this run only
+        for path in self.memmap_files:
+            os.remove(path)
+        self.memmap_files.clear()
+
     def save(self):
         torch.save(
-            {"actor": self.actor.state_dict(), "critic": self.critic.state_dict()},
+            {
+                "actor": unwrap(self.actor).state_dict(),
+                "critic": unwrap(self.critic).state_dict(),
+            },
             f"./ppg.pt",
         )
 
@@ -176,148 +449,182 @@ class PPG:
             return
 
         data = torch.load(f"./ppg.pt")
-        self.actor.load_state_dict(data["actor"])
-        self.critic.load_state_dict(data["critic"])
-
-    def learn(self, memories, aux_memories, next_state):
-        # retrieve and prepare data from memory for training
-        states = []
-        actions = []
-        old_log_probs = []
-        rewards = []
-        masks = []
-        values = []
-
-        for mem in memories:
-            states.append(mem.state)
-            actions.append(torch.tensor(mem.action))
-            old_log_probs.append(mem.action_log_prob)
-            rewards.append(mem.reward)
-            masks.append(1 - float(mem.done))
-            values.append(mem.value)
-
-        # calculate generalized advantage estimate
-        next_state = torch.from_numpy(next_state).to(device)
-        next_value = self.critic(next_state).detach()
-        values = values + [next_value]
-        global_step = 0
-
-        returns = []
-        gae = 0
-        for i in reversed(range(len(rewards))):
-            delta = rewards[i] + self.gamma * values[i + 1] * masks[i] - values[i]
-            gae = delta + self.gamma * self.lam * masks[i] * gae
-            returns.insert(0, gae + values[i])
-
-        # convert values to torch tensors
-        to_torch_tensor = lambda t: torch.stack(t).to(device).detach()
-
-        states = to_torch_tensor(states)
-        actions = to_torch_tensor(actions)
-        old_values = to_torch_tensor(values[:-1])
-        old_log_probs = to_torch_tensor(old_log_probs)
-
-        rewards = torch.tensor(returns).float().to(device)
+        unwrap(self.actor).load_state_dict(data["actor"])
+        unwrap(self.critic).load_state_dict(data["critic"])
+
+    def learn(self, next_state):
+        # calculate generalized advantage estimate, per environment along the time axis
+        next_state = self.load_obs(next_state)
+        with torch.no_grad():
+            self.values_buf[-1] = self.critic(next_state).flatten()
+
+        rewards = self.rewards_buf.to(device, non_blocking=True)
+        masks = 1 - self.dones_buf.to(device, non_blocking=True)
+
+        # advantages are computed in place in the returns buffer, then offset by the values
+        # the dones are still on the host, so checking for episode ends costs no device sync
+        if self.parallel_gae and not self.dones_buf.any():
+            compute_gae_without_resets(
+                rewards, self.values_buf, self.gamma, self.lam, self.returns_buf
+            )
+        else:
+            compute_gae(
+                rewards,
+                self.values_buf,
+                masks,
+                float(self.gamma),
+                float(self.lam),
+                self.returns_buf,
+            )
+        self.returns_buf.add_(self.values_buf[:-1])
+
+        # flatten the (time, environment) axes into a single batch
+        states = self.states_buf.flatten(0, 1)
+        actions = self.actions_buf.flatten()
+        old_values = self.values_buf[:-1].flatten()
+        old_log_probs = self.log_probs_buf.flatten()
+
+        rewards = self.returns_buf.flatten()
 
         # store state and target values to auxiliary memory buffer for later training
-        aux_memory = AuxMemory(states, rewards, old_values)
-        aux_memories.append(aux_memory)
+        # the rollout buffers are overwritten by the next rollout, hence the copies
+        self.aux_states[self.aux_t] = states
+        self.aux_rewards[self.aux_t] = rewards
+        self.aux_old_values[self.aux_t] = old_values
+        self.aux_t += 1
 
-        # prepare dataloader for policy phase training
-        dl = create_shuffled_dataloader(
-            [states, actions, old_log_probs, rewards, old_values], self.minibatch_size
-        )
+        # prepare data for policy phase training
+        data = [states, actions, old_log_probs, rewards, old_values]
 
         # policy phase training, similar to original PPO
         for _ in range(self.epochs):
-            for states, actions, old_log_probs, rewards, old_values in dl:
-                action_probs, _ = self.actor(states)
-                values = self.critic(states)
-                dist = Categorical(action_probs)
-                action_log_probs = dist.log_prob(actions)
-                entropy = dist.entropy()
-                global_step += 1
-
-                # calculate clipped surrogate objective, classic PPO loss
-                ratios = (action_log_probs - old_log_probs).exp()
-                advantages = normalize(rewards - old_values.detach())
-                surr1 = ratios * advantages
-                surr2 = ratios.clamp(1 - self.eps_clip, 1 + self.eps_clip) * advantages
-                policy_loss = -torch.min(surr1, surr2) - self.beta_s * entropy
-                self.writer.add_scalar(
-                    "losses/policy_loss", policy_loss.mean().item(), global_step
+            for states, actions, old_log_probs, rewards, old_values in self.minibatches(
+                data
+            ):
+                with self.autocast():
+                    action_logits, _ = self.actor(states)
+                    values = self.critic(states)
+                    log_probs = F.log_softmax(action_logits, dim=-1)
+                    action_log_probs = gather_actions(log_probs, actions)
+                    entropy = -(log_probs.exp() * log_probs).sum(dim=-1)
+
+                    # calculate clipped surrogate objective, classic PPO loss
+                    ratios = (action_log_probs - old_log_probs).exp()
+                    advantages = normalize(rewards - old_values.detach())
+                    surr1 = ratios * advantages
+                    surr2 = (
+                        ratios.clamp(1 - self.eps_clip, 1 + self.eps_clip) * advantages
+                    )
+                    policy_loss = -torch.min(surr1, surr2) - self.beta_s * entropy
+
+                    # calculate value loss, the value network is still updated separately from the policy network
+                    value_loss = clipped_value_loss(
+                        values, rewards, old_values, self.value_clip
+                    )
+
+                self._loss_log["policy_loss"].append(
+                    policy_loss.detach().mean().float()
                 )
+                self._loss_log["value_loss"].append(value_loss.detach().float())
 
-                update_network_(policy_loss, self.opt_actor)
-
-                # calculate value loss and update value network separate from policy network
-                value_loss = clipped_value_loss(
-                    values, rewards, old_values, self.value_clip
+                update_networks_(
+                    policy_loss.mean() + value_loss,
+                    (self.opt_actor, self.opt_critic),
+                    self.scaler,
                 )
-                self.writer.add_scalar("losses/value_loss", value_loss.item())
-                # self.writer.add_scalar("losses/entropy", entropy.item())
-
-                update_network_(value_loss, self.opt_critic)
 
-    def learn_aux(self, aux_memories):
-        # gather states and target values into one tensor
-        states = []
-        rewards = []
-        old_values = []
-        for state, reward, old_value in aux_memories:
-            states.append(state)
-            rewards.append(reward)
-            old_values.append(old_value)
+            self.flush_losses()
 
-        states = torch.cat(states)
-        rewards = torch.cat(rewards)
-        old_values = torch.cat(old_values)
+    def learn_aux(self):
+        # the filled slots of the auxiliary storage, viewed as one batch
+        states = self.aux_states[: self.aux_t].flatten(0, 1)
+        rewards = self.aux_rewards[: self.aux_t].flatten()
+        old_values = self.aux_old_values[: self.aux_t].flatten()
+        self.aux_t = 0
 
         # get old action predictions for minimizing kl divergence and clipping respectively
-        old_action_probs, _ = self.actor(states)
-        old_action_probs.detach_()
+        # states paged in from the host are evaluated a minibatch at a time, each output is cloned
+        # as the next call of a compiled actor overwrites it
+        with torch.no_grad():
+            if states.device == device:
+                old_action_logits, _ = self.actor(states)
+            else:
+                old_action_logits = torch.cat(
+                    [
+                        self.actor(batch[0])[0].clone()
+                        for batch in self.minibatches([states], shuffle=False)
+                    ]
+                )
+            old_action_logprobs = F.log_softmax(old_action_logits, dim=-1)
 
-        # prepared dataloader for auxiliary phase training
-        dl = create_shuffled_dataloader(
-            [states, old_action_probs, rewards, old_values], self.minibatch_size
-        )
+        # prepare data for auxiliary phase training
+        data = [states, old_action_logprobs, rewards, old_values]
+        num_minibatches = math.ceil(len(states) / self.minibatch_size)
 
         # the proposed auxiliary phase training
         # where the value is distilled into the policy network, while making sure the policy network does not change the action predictions (kl div loss)
         for epoch in range(self.epochs_aux):
-            for states, old_action_probs, rewards, old_values in tqdm(
-                dl, desc=f"auxiliary epoch {epoch}"
+            for states, old_action_logprobs, rewards, old_values in tqdm(
+                self.minibatches(data),
+                desc=f"auxiliary epoch {epoch}",
+                total=num_minibatches,
             ):
-                action_probs, policy_values = self.actor(states)
-                action_logprobs = action_probs.log()
-
-                # policy network loss composes of both the kl div loss as well as the auxiliary loss
-                aux_loss = clipped_value_loss(
-                    policy_values, rewards, old_values, self.value_clip
+                with self.autocast():
+                    action_logits, policy_values = self.actor(states)
+                    action_logprobs = F.log_softmax(action_logits, dim=-1)
+
+                    # policy network loss composes of both the kl div loss as well as the auxiliary loss
+                    aux_loss = clipped_value_loss(
+                        policy_values, rewards, old_values, self.value_clip
+                    )
+                    # both distributions stay in log space, no softmax or log of probabilities
+                    loss_kl = F.kl_div(
+                        action_logprobs,
+                        old_action_logprobs,
+                        reduction="batchmean",
+                        log_target=True,
+                    )
+                    policy_loss = aux_loss + loss_kl
+
+                    # paper says it is important to train the value network extra during the auxiliary phase
+                    values = self.critic(states)
+                    value_loss = clipped_value_loss(
+                        values, rewards, old_values, self.value_clip
+                    )
+
+                self._loss_log["aux_loss"].append(aux_loss.detach().float())
+                self._loss_log["kl_loss"].append(loss_kl.detach().float())
+
+                update_networks_(
+                    policy_loss + value_loss,
+                    (self.opt_actor, self.opt_critic),
+                    self.scaler,
                 )
-                loss_kl = F.kl_div(
-                    action_logprobs, old_action_probs, reduction="batchmean"
-                )
-                policy_loss = aux_loss + loss_kl
-                self.writer.add_scalar("losses/aux_loss", aux_loss.item())
-                self.writer.add_scalar("losses/kl_loss", loss_kl.item())
 
-                update_network_(policy_loss, self.opt_actor)
+            self.flush_losses()
 
-                # paper says it is important to train the value network extra during the auxiliary phase
-                values = self.critic(states)
-                value_loss = clipped_value_loss(
-                    values, rewards, old_values, self.value_clip
-                )
 
-                update_network_(value_loss, self.opt_critic)
+# main
 
 
-# main
+def make_env(env_name, seed, idx, max_timesteps, monitor_dir=None):
+    def thunk():
+        env = gym.make(env_name)
+        env = gym.wrappers.TimeLimit(env, max_episode_steps=max_timesteps)
+        env = gym.wrappers.RecordEpisodeStatistics(env)
+        if exists(monitor_dir) and idx == 0:
+            env = gym.wrappers.Monitor(env, monitor_dir, force=True)
+        if exists(seed):
+            env.seed(seed)
+            env.action_space.seed(seed)
+        return env
+
+    return thunk
 
 
 def main(
     env_name: str = "LunarLander-v2",
+    num_envs: int = 8,
     num_episodes: int = 50000,
     max_timesteps: int = 500,
     actor_hidden_dim: int = 32,
@@ -341,17 +648,44 @@ def main(
     load: bool = False,
     monitor: bool = False,
     wandb_save: bool = False,
+    rollout_file: str = None,
+    compile_model: bool = False,
+    distributed: bool = False,
+    precision: str = "fp32",
+    cuda_graph: bool = False,
 ):
 
     args = locals()
-    env = gym.make(env_name)
-    logger.info(f"Building environment for {env_name}")
     exp_name = f"{env_name}_{datetime.datetime.now().strftime('%Y_%m_%d_%H_%M_%S')}"
 
-    if monitor:
-        env = gym.wrappers.Monitor(env, f"runs/{exp_name}", force=True)
-
-    if wandb_save:
+    # every rank steps its own environments, only rank 0 saves and reports
+    rank = setup_distributed() if distributed else 0
+
+    # one forward pass through the networks services a whole group of environments at every step
+    logger.info(f"Building {num_envs} environments for {env_name}")
+    env_fns = [
+        make_env(
+            env_name,
+            seed + rank * num_envs + i if exists(seed) else None,
+            i,
+            max_timesteps,
+            f"runs/{exp_name}" if monitor and rank == 0 else None,
+        )
+        for i in range(num_envs)
+    ]
+
+    # the environments are split into two groups that take turns, one group steps in its worker
+    # processes while the networks act for the other, an odd number of environments stays in one group
+    num_env_groups = 2 if num_envs > 1 and num_envs % 2 == 0 else 1
+    group_size = num_envs // num_env_groups
+    group_envs = [
+        slice(group * group_size, (group + 1) * group_size)
+        for group in range(num_env_groups)
+    ]
+    vec_env_cls = SubprocVecEnv if num_envs > 1 else DummyVecEnv
+    env_groups = [vec_env_cls(env_fns[envs]) for envs in group_envs]
+
+    if wandb_save and rank == 0:
         wandb.init(
             project="ppg-experiments",
             sync_tensorboard=True,
@@ -360,22 +694,32 @@ def main(
             save_code=True,
         )
 
-    writer = SummaryWriter(f"runs/{exp_name}")
+    writer = SummaryWriter(
+        f"runs/{exp_name}" if rank == 0 else f"runs/{exp_name}_rank{rank}"
+    )
     writer.add_text(
         "hyperparameters",
         "|param|value|\n|-|-|\n%s"
         % ("\n".join([f"|{key}|{value}|" for key, value in args.items()])),
     )
 
-    state_dim = env.observation_space.shape[0]
-    num_actions = env.action_space.n
+    state_dim = env_groups[0].observation_space.shape[0]
+    num_actions = env_groups[0].action_space.n
+
+    # tf32 matmuls on ampere and newer, the networks are far from needing full fp32 precision
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
 
-    memories = deque([])
-    aux_memories = deque([])
+    # update_timesteps counts transitions across all environments
+    num_steps = int(update_timesteps // num_envs)
+    num_policy_updates_per_aux = int(num_policy_updates_per_aux)
 
     agent = PPG(
         state_dim,
         num_actions,
+        num_steps,
+        num_envs,
+        num_policy_updates_per_aux,
         actor_hidden_dim,
         critic_hidden_dim,
         epochs,
@@ -389,73 +733,127 @@ def main(
         eps_clip,
         value_clip,
         writer=writer,
+        rollout_file=f"{rollout_file}.{rank}"
+        if exists(rollout_file) and distributed
+        else rollout_file,
+        compile_model=compile_model,
+        distributed=distributed,
+        precision=precision,
+        cuda_graph=cuda_graph,
+        num_env_groups=num_env_groups,
     )
 
-    if load:
-        agent.load()
+    # the memory mapped scratch files are removed even when training crashes or is interrupted
+    try:
+        if load:
+            agent.load()
+
+        # ranks seed differently, otherwise they would draw the same action noise and minibatch order
+        if exists(seed):
+            torch.manual_seed(seed + rank)
+            np.random.seed(seed + rank)
+
+        time = 0
+        eps = 0
+        updated = False
+        render_eps = render
+        num_policy_updates = 0
 
-    if exists(seed):
-        torch.manual_seed(seed)
-        np.random.seed(seed)
+        finished = 0
+        pbar = tqdm(total=num_episodes, desc="episodes", disable=rank != 0)
+        states = [group.reset() for group in env_groups]
 
-    time = 0
-    updated = False
-    num_policy_updates = 0
+        def act(group, timestep):
+            envs = group_envs[group]
+            state = agent.load_obs(states[group], envs)
+            with torch.no_grad():
+                action_logits, value = agent.rollout_act(state)
+                action, action_log_prob = sample_actions(action_logits)
 
-    for eps in tqdm(range(num_episodes), desc="episodes"):
-        render_eps = render and eps % render_every_eps == 0
-        state = env.reset()
-        for timestep in range(max_timesteps):
-            time += 1
+            env_groups[group].step_async(action.cpu().numpy())
 
-            if updated and render_eps:
-                env.render()
+            agent.states_buf[timestep, envs] = state
+            agent.actions_buf[timestep, envs] = action
+            agent.log_probs_buf[timestep, envs] = action_log_prob
+            agent.values_buf[timestep, envs] = value
 
-            state = torch.from_numpy(state).to(device)
-            action_probs, _ = agent.actor(state)
-            value = agent.critic(state)
+        def collect(group, timestep):
+            nonlocal eps, render_eps
 
-            dist = Categorical(action_probs)
-            action = dist.sample()
-            action_log_prob = dist.log_prob(action)
-            action = action.item()
+            envs = group_envs[group]
+            states[group], reward, done, infos = env_groups[group].step_wait()
+            agent.rewards_buf[timestep, envs] = torch.from_numpy(reward)
+            agent.dones_buf[timestep, envs] = torch.from_numpy(done)
 
-            next_state, reward, done, infos = env.step(action)
-            if wandb_save:
-                writer.add_scalar("charts/episode_reward", time)
             for info in infos:
                 if "episode" in info.keys():
                     print(f"time={time}, episode_reward={info['episode']['r']}")
-                    break
-            memory = Memory(state, action, action_log_prob, reward, done, value)
-            memories.append(memory)
+                    writer.add_scalar(
+                        "charts/episode_reward", info["episode"]["r"], time
+                    )
+
+                    if eps % save_every == 0 and rank == 0:
+                        agent.save()
+
+                    eps += 1
+                    pbar.update(1)
+                    render_eps = render and eps % render_every_eps == 0
+
+        while finished < num_episodes:
+            # the group whose step has been launched but not yet collected
+            pending = None
 
-            state = next_state
+            for timestep in range(num_steps):
+                time += num_envs
 
-            if time % update_timesteps == 0:
-                agent.learn(memories, aux_memories, next_state)
-                num_policy_updates += 1
-                memories.clear()
+                # only the first environment is shown, tiling every environment needs opencv
+                if updated and render_eps:
+                    env_groups[0].env_method("render", indices=0)
 
-                if num_policy_updates % num_policy_updates_per_aux == 0:
-                    agent.learn_aux(aux_memories)
-                    aux_memories.clear()
+                for group in range(num_env_groups):
+                    # a group acts on its latest observation, so its previous step has to be collected first
+                    if exists(pending) and pending[0] == group:
+                        collect(*pending)
+                        pending = None
 
-                updated = True
+                    act(group, timestep)
 
-            if done:
-                if render_eps:
-                    updated = False
-                break
+                    # the other group was stepping while this group went through the networks
+                    if exists(pending):
+                        collect(*pending)
 
-        if render_eps:
-            env.close()
+                    pending = (group, timestep)
 
-        if eps % save_every == 0:
-            agent.save()
+            collect(*pending)
 
+            agent.learn(np.concatenate(states))
+            num_policy_updates += 1
+
+            if num_policy_updates % num_policy_updates_per_aux == 0:
+                agent.learn_aux()
+
+            updated = True
+
+            # all ranks must agree on when to stop, otherwise the gradient all-reduce hangs
+            # num_episodes counts per rank, so the run ends once the slowest rank has finished its episodes
+            finished = eps
+            if distributed:
+                finished = torch.tensor(eps, device=device)
+                torch.distributed.all_reduce(
+                    finished, op=torch.distributed.ReduceOp.MIN
+                )
+                finished = finished.item()
+    finally:
+        agent.close()
+
+    pbar.close()
+    for group in env_groups:
+        group.close()
     writer.close()
 
+    if distributed:
+        torch.distributed.destroy_process_group()
+
 
 if __name__ == "__main__":
     fire.Fire(main)